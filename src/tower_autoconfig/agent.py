@@ -1,7 +1,9 @@
-import asyncio, contextlib, os
+import asyncio, collections, contextlib, logging, logging.handlers, os, queue
 import tower_autoconfig
 
 EXEC_PATH=f'{tower_autoconfig.__path__[0]}/bin/tw-agent-timeout'
+READ_SIZE=64*1024
+MAX_LINE=64*1024
 
 class TowerAgentError(Exception):
     pass
@@ -10,9 +12,11 @@ class TowerAgentError(Exception):
 Provides a nice async context manager for the Tower Agent with error reporting
 Also uses a lightweight bash wrapper to prevent the Agent accidentally running forever
 If this feature is added to the official agent, we can still keep the context manager
+Both stdout and stderr are drained for the lifetime of the agent, so it never blocks on a full pipe. The last
+lines are kept in memory for error reporting and can optionally be written to a size-rotated log file.
 '''
 class TowerAgentTimeout:
-    def __init__(self, agent_connection_id, workdir, server, timeout, leave_alive=False, bearer=None):
+    def __init__(self, agent_connection_id, workdir, server, timeout, leave_alive=False, bearer=None, log_path=None, log_max_bytes=10*1024*1024, log_lines=200):
         self.agent_connection_id = agent_connection_id
         self.workdir = workdir
         self.server = server
@@ -21,25 +25,80 @@ class TowerAgentTimeout:
         self.pid = None
         self.cmd = ''
         self.env = {**os.environ.copy(), 'TOWER_ACCESS_TOKEN': bearer} if bearer else None
+        self.lines = collections.deque(maxlen=log_lines)
+        self._established = None
+        self._drains = []
+        self._log_queue = self._log_listener = None
+        if log_path:
+            # File writes happen on the listener's thread, and lines are dropped rather than queued forever if the disk stalls
+            handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=log_max_bytes, backupCount=1)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._log_queue = queue.Queue(maxsize=10000)
+            self._log_listener = logging.handlers.QueueListener(self._log_queue, handler)
+
+    def _record(self, name, line):
+        line = line.decode(errors='replace')
+        self.lines.append(f'{name}: {line[:1000]}')
+        if self._log_queue:
+            with contextlib.suppress(queue.Full):
+                self._log_queue.put_nowait(logging.makeLogRecord({'msg': f'{name}: {line}', 'levelno': logging.INFO, 'levelname': 'INFO'}))
+        if name == 'stdout' and line.endswith('Connection to Tower established'):
+            self._established.set()
+
+    async def _drain(self, stream, name):
+        # Raw chunks rather than readline(), which gives up on lines longer than the StreamReader limit
+        partial = b''
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            if not chunk:
+                break
+            *lines, partial = (partial + chunk).split(b'\n')
+            if len(partial) > MAX_LINE:
+                lines.append(partial)
+                partial = b''
+            for line in lines:
+                self._record(name, line)
+        if partial:
+            self._record(name, partial)
+
+    def _error(self, msg):
+        return TowerAgentError(msg) if not self.lines else TowerAgentError(f'{msg}:\n' + '\n'.join(self.lines))
 
     async def __aenter__(self):
-        stdout = ''
         self.cmd = [EXEC_PATH, self.agent_connection_id, self.workdir, self.server, str(self.timeout)]
         self.p = await asyncio.create_subprocess_exec(*self.cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True, env=self.env)
         self.pid = self.p.pid
-        async for line in self.p.stdout:
-            line = line.decode()
-            stdout += line
-            if line.endswith('Connection to Tower established\n'): 
-                break
-        else:
-            await self.p.wait()
-            e = RuntimeError((await self.p.stderr.read()).decode() or stdout)
-            raise TowerAgentError('Tower agent could not be started') from e
+        self._established = asyncio.Event()
+        if self._log_listener:
+            self._log_listener.start()
+        self._drains = [asyncio.ensure_future(self._drain(self.p.stdout, 'stdout')), asyncio.ensure_future(self._drain(self.p.stderr, 'stderr'))]
+
+        # The bash wrapper's timeout is for inactivity, so also enforce it here as a startup deadline
+        established = asyncio.ensure_future(self._established.wait())
+        exited = asyncio.ensure_future(self.p.wait())
+        await asyncio.wait([established, exited], timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+        established.cancel()
+        exited.cancel()
+
+        if not self._established.is_set():
+            timed_out = self.p.returncode is None
+            await self._stop()
+            raise self._error(f'Tower agent could not be started{f" within {self.timeout}s" if timed_out else ""}')
         return self
-        
+
+    async def _stop(self):
+        with contextlib.suppress(ProcessLookupError):
+            self.p.terminate()
+        await self.p.wait()
+        # Pipes hit EOF once the process is gone, letting the drains collect the final lines (unless a child still holds them)
+        _, pending = await asyncio.wait(self._drains, timeout=5)
+        for task in pending:
+            task.cancel()
+        if self._log_listener:
+            self._log_listener.stop()
+            self._log_listener.handlers[0].close()
+
     async def __aexit__(self, exc_type, exc, tb):
+        # If left alive, draining continues for as long as the event loop runs
         if not self.leave_alive:
-            with contextlib.suppress(ProcessLookupError): 
-                self.p.terminate()
-            await self.p.wait()
+            await self._stop()
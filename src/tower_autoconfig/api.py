@@ -1,5 +1,5 @@
 import asyncio, logging
-from typing import List, Any, Optional
+from typing import List, Any, Optional, Tuple
 import aiohttp
 
 class TowerApiError(Exception):
@@ -8,6 +8,9 @@ class TowerApiError(Exception):
 RECOGNIZED_PLATFORMS = {'aws-batch', 'google-lifesciences', 'google-batch', 'azure-batch', 'k8s-platform', 'eks-platform', 
                              'gke-platform', 'uge-platform', 'slurm-platform', 'lsf-platform', 'altair-platform', 'moab-platform'}
 
+# Returned when describing a pipeline launch, but not accepted back when updating it
+PIPELINE_LAUNCH_READ_ONLY = {'computeEnv', 'id', 'dateCreated', 'lastUpdated'}
+
 '''
 Simplified Nextflow Tower API, does not provide control over all parameters.
 In particular, compute environment fields beyond the platform, username and hostname.
@@ -118,6 +121,12 @@ class TowerApi:
     async def get_credentials_id_by_compute(self, compute_id: str) -> Optional[str]:
         return (await self._handle_get_json(f'compute-envs/{compute_id}'))['credentialsId']
 
+    async def get_compute_env(self, compute_id: str) -> Any:
+        return (await self._handle_get_json(f'compute-envs/{compute_id}'))['computeEnv']
+
+    async def get_compute_status(self, compute_id: str) -> str:
+        return (await self.get_compute_env(compute_id))['status']
+
     async def add_credentials_ssh(self, credentials_name: str, credentials_description: str, existing_id: str, ssh_key: str) -> str:
         credential_data = {
             'credentials': {
@@ -180,6 +189,20 @@ class TowerApi:
             return existing_id
         return (await self._handle_json_post_json('compute-envs', compute_data, expected_status_code=200))['computeEnvId']
 
+    async def update_compute_head_job_options(self, compute_env: Any, compute_queue_options: str):
+        # The described config is sent back whole, so settings this class doesn't manage (prerun, env vars, queues...) are kept
+        compute_data = {
+            'computeEnv': {
+                'id': compute_env['id'],
+                'name': compute_env['name'],
+                'description': compute_env.get('description'),
+                'credentialsId': compute_env['credentialsId'],
+                'platform': compute_env['platform'],
+                'config': {**compute_env['config'], 'headJobOptions': compute_queue_options.replace('"', '')}
+            }
+        }
+        await self._handle_json_put_json(f'compute-envs/{compute_env["id"]}', compute_data, expected_status_code=204)
+
     async def make_compute_primary(self, compute_id: str) -> bool:
         await self._handle_json_post_json(f'compute-envs/{compute_id}/primary', {})
 
@@ -210,12 +233,34 @@ class TowerApi:
             return existing_id
         return (await self._handle_json_post_json('pipelines', pipeline_data, expected_status_code=200))['pipeline']['pipelineId']
 
+    async def get_pipeline_launch(self, pipeline_id: str) -> Any:
+        return (await self._handle_get_json(f'pipelines/{pipeline_id}/launch'))['launch']
+
+    async def update_pipeline_launch(self, pipeline_id: str, pipeline_name: str, pipeline_description: str, pipeline_icon: str, launch: Any, label_ids: List[str], fields: dict):
+        # Tower has no PATCH for pipelines, so the existing launch is echoed back with only the changed fields replaced
+        pipeline_data = {
+            'name': pipeline_name,
+            'description': pipeline_description,
+            'icon': pipeline_icon,
+            'launch': {
+                **{k: v for k, v in launch.items() if k not in PIPELINE_LAUNCH_READ_ONLY},
+                'computeEnvId': launch['computeEnv']['id'],
+                **fields
+            },
+            'labelIds': label_ids
+        }
+        await self._handle_json_put_json(f'pipelines/{pipeline_id}', pipeline_data, expected_status_code=200)
+
     async def remove_pipeline(self, pipeline_id: str):
         await self._handle_json_delete_json(f'pipelines/{pipeline_id}')
 
     async def get_pipelines(self, attributes: List[str]=[]) -> List[Any]:
         return (await self._handle_get_json('pipelines', params={'attributes': ','.join(attributes)}))['pipelines']
 
+    async def get_workflows(self, max: int, offset: int, search: Optional[str]=None) -> Tuple[List[Any], int]:
+        response = await self._handle_get_json('workflow', params={'max': max, 'offset': offset, **({'search': search} if search else {})})
+        return response['workflows'], response.get('totalSize', 0)
+
     async def get_labels(self) -> List[Any]:
         return (await self._handle_get_json('labels', params={'max':9999}))['labels']
 
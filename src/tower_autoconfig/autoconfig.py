@@ -1,9 +1,10 @@
-import asyncio, logging, urllib, json
+import asyncio, logging, urllib, json, random, time
 from typing import List, Optional
 
 from tower_autoconfig.api import TowerApi, TowerApiError
 from tower_autoconfig.utils import create_ssh_key, delete_ssh_key
 from tower_autoconfig.agent import TowerAgentTimeout
+from tower_autoconfig.sizing import PLATFORM_WALLTIME, HeadJobHistory, HeadJobSizingError, propose_walltime, size_head_job_options
 
 class TowerAutoconfigError(Exception):
     pass
@@ -84,11 +85,53 @@ class TowerAutoconfig:
         
         return (user, compute_id, compute_primary_id, credentials_id, *pipeline_ret)
 
+    async def _wait_for_compute(self, compute_id: str, initial_delay: float, max_delay: float):
+        delay = initial_delay
+        while True:
+            try:
+                status = await self.api.get_compute_status(compute_id)
+            except TowerApiError as e:
+                # Transient failures are retried until the overall deadline
+                status = None
+                logging.debug(f'compute {compute_id} status unavailable: {e}')
+            logging.debug(f'compute {compute_id} is {status}')
+            if status == 'AVAILABLE':
+                return
+            if status in ('ERRORED', 'INVALID'):
+                raise TowerAutoconfigError(f'Compute environment {compute_id} is {status} - check it in the Tower UI')
+            # Full jitter, so several waiters (or several users) don't poll in lockstep
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, max_delay)
+
+    async def wait_for_compute(self, compute_ids: List[str], timeout: float, initial_delay: float=1, max_delay: float=30):
+        start = time.monotonic()
+        tasks = [asyncio.ensure_future(self._wait_for_compute(i, initial_delay, max_delay)) for i in compute_ids]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # Stop the other pollers as soon as one fails, the deadline passes or we are cancelled ourselves
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+        if pending:
+            raise TowerAutoconfigError(f'Compute environment(s) not AVAILABLE after {timeout}s')
+        logging.info(f'Compute environment(s) AVAILABLE after {time.monotonic() - start:.1f}s')
+
+    async def _wait_for_compute_or_warn(self, compute_id: str, timeout: float):
+        # The compute environment already exists at this point, so don't abandon the rest of setup
+        try:
+            await self.wait_for_compute([compute_id], timeout)
+        except TowerAutoconfigError as e:
+            logging.warning(f'{e} - continuing setup')
+
     def clean_ssh(self):
         delete_ssh_key(self.ssh_key_comment)
 
     async def setup_ssh(self, compute_name: str, compute_description: str, compute_platform: str, compute_host: str, compute_user: str, compute_queue_options: str, workdir: str,
-        credentials_name: str, credentials_description: str, compute_id: Optional[str]=None, credentials_id: Optional[str]=None, shouldForce: bool=False, ssh_restrictions: str='') -> str:
+        credentials_name: str, credentials_description: str, compute_id: Optional[str]=None, credentials_id: Optional[str]=None, shouldForce: bool=False, ssh_restrictions: str='', wait_timeout: float=0) -> str:
 
         if not compute_id or shouldForce:
             if not credentials_id or shouldForce:
@@ -102,21 +145,42 @@ class TowerAutoconfig:
                 await self.api.remove_credentials(credentials_id)
                 raise TowerAutoconfigError("Failed to create compute environment - this usually means this machine isn't open to the internet. Try specifying --node to the main login node, or use the agent method.") from e
 
+            if wait_timeout:
+                await self._wait_for_compute_or_warn(compute_id, wait_timeout)
+
         return compute_id, credentials_id
 
     async def setup_agent(self, compute_name: str, compute_description: str, compute_platform: str, compute_host: str, compute_user: str, compute_queue_options: str, workdir: str,
-        credentials_name: str, credentials_description: str, compute_id: Optional[str]=None, credentials_id: Optional[str]=None, shouldForce: bool=False, agent_connection_id: str='autoconfigured', bearer: str=None) -> str:
+        credentials_name: str, credentials_description: str, compute_id: Optional[str]=None, credentials_id: Optional[str]=None, shouldForce: bool=False, agent_connection_id: str='autoconfigured', bearer: str=None, wait_timeout: float=0, agent_log: Optional[str]=None) -> str:
 
         if not compute_id or shouldForce:            
             # Start agent on hard-coded connection ID
-            async with TowerAgentTimeout(agent_connection_id, workdir, self.endpoint, 300, bearer=bearer) as agent:
+            async with TowerAgentTimeout(agent_connection_id, workdir, self.endpoint, 300, bearer=bearer, log_path=agent_log) as agent:
                 # Create matching credential and/or compute while agent is running
                 if not credentials_id or shouldForce:
                     credentials_id = await self.api.add_credentials_agent(credentials_name, credentials_description, workdir, credentials_id, agent_connection_id)
                 compute_id = await self.api.add_compute(compute_name, compute_description, compute_platform, compute_host, compute_user, compute_queue_options, credentials_id, workdir, compute_id)
 
+                # Tower validates through the agent, so it must stay alive until then
+                if wait_timeout:
+                    await self._wait_for_compute_or_warn(compute_id, wait_timeout)
+
         return compute_id, credentials_id
     
+    async def propose_head_job_options(self, compute_id: str, queue_options: Optional[str]=None, percentile: float=95, max_runs: int=1000):
+        compute_env = await self.api.get_compute_env(compute_id)
+        if compute_env['platform'] not in PLATFORM_WALLTIME:
+            raise HeadJobSizingError(f'Head job sizing is not supported for "{compute_env["platform"]}", only {", ".join(PLATFORM_WALLTIME)}')
+        config = compute_env['config']
+        history = await HeadJobHistory(compute_id, config.get('workDir')).load(self.api, max_runs)
+        duration = history.durations.percentile(percentile)
+        current = queue_options if queue_options is not None else config.get('headJobOptions')
+        proposed = None if duration is None else size_head_job_options(compute_env['platform'], current, propose_walltime(duration))
+        return compute_env, history, duration, current, proposed
+
+    async def apply_head_job_options(self, compute_env, queue_options: str):
+        await self.api.update_compute_head_job_options(compute_env, queue_options)
+
     async def setup_pipelines(self, compute_id, pipelines_add, pipeline_name_to_id, label_name_to_id, remote_pipelines_dict, pipeline_suffix, config_text, prerun_text, workdir, profiles):
         tasks = []
         description_suffix = ' (NOTE: if you rename this, tower_autoconfig cannot clean it)'
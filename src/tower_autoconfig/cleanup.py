@@ -0,0 +1,159 @@
+import os, re, stat, time, fcntl, glob, threading, logging, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+
+TASK_BUCKET = re.compile(r'^[0-9a-f]{2}$')
+TASK_DIR = re.compile(r'^[0-9a-f]{30}$')
+
+'''
+Thread-safe token bucket shared by every scandir/unlink/rmdir, so a large delete can't flood the metadata servers
+'''
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def __call__(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+class TaskDir:
+    def __init__(self, path: str):
+        self.path = path
+        self.bytes = 0
+        self.inodes = 1
+        self.mtime = 0.0
+
+'''
+Finds Nextflow task directories (<work>/ab/cdef...) in a launch directory, sizes them and deletes them, all with a thread pool.
+Only the launch directory itself and its work/ child are treated as work directories, and only whole task directories
+are removed - nothing else (logs, .nextflow, results, caches) is walked or deleted.
+Work trees with a running Nextflow session (a held cache LOCK, or an active run in Tower) are skipped entirely,
+since resumed runs can read from task directories of any age.
+'''
+class WorkdirCleaner:
+    def __init__(self, launchdir: str, older_than_days: float=7, min_bytes: int=0, threads: int=8, max_ops: float=2000, active_workdirs: Iterable[str]=()):
+        self.launchdir = os.path.abspath(launchdir)
+        self.cutoff = time.time() - older_than_days * 86400
+        self.min_bytes = min_bytes
+        self.threads = threads
+        self.limit = RateLimiter(max_ops)
+        self.active_workdirs = {os.path.abspath(w).rstrip('/') for w in active_workdirs}
+        self.tasks: List[TaskDir] = []
+        self.skipped_trees: List[str] = []
+        self.errors = 0
+        self._errors_lock = threading.Lock()
+
+    def _scandir(self, path: str) -> List[os.DirEntry]:
+        self.limit()
+        try:
+            with os.scandir(path) as it:
+                return list(it)
+        except OSError as e:
+            logging.debug(f'could not scan {path}: {e}')
+            return []
+
+    def _size(self, task: TaskDir):
+        dirs = [task.path]
+        while dirs:
+            for entry in self._scandir(dirs.pop()):
+                with contextlib.suppress(OSError):
+                    st = entry.stat(follow_symlinks=False)
+                    task.inodes += 1
+                    task.mtime = max(task.mtime, st.st_mtime)
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs.append(entry.path)
+                    else:
+                        task.bytes += st.st_blocks * 512
+        with contextlib.suppress(OSError):
+            task.mtime = max(task.mtime, os.stat(task.path).st_mtime)
+        return task
+
+    def _is_in_use(self, work_tree: str) -> bool:
+        if work_tree.rstrip('/') in self.active_workdirs:
+            return True
+        # LevelDB holds an exclusive lock on the cache while a session runs (only visible from this host)
+        parent = os.path.dirname(work_tree) if os.path.basename(work_tree) == 'work' else work_tree
+        for lock_path in glob.glob(os.path.join(parent, '.nextflow', 'cache', '*', 'db', 'LOCK')):
+            try:
+                with open(lock_path, 'a') as f:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+            except OSError:
+                return True
+        return False
+
+    def _work_roots(self) -> List[str]:
+        # Pipelines are created with --launchdir as their workDir, and a plain "nextflow run" there uses work/
+        roots = [self.launchdir, os.path.join(self.launchdir, 'work')]
+        return [r for r in roots if os.path.isdir(r) and not os.path.islink(r)]
+
+    def _buckets(self, work_root: str) -> List[str]:
+        return [e.path for e in self._scandir(work_root) if TASK_BUCKET.match(e.name) and e.is_dir(follow_symlinks=False)]
+
+    def _tasks(self, bucket: str) -> List[TaskDir]:
+        return [TaskDir(e.path) for e in self._scandir(bucket) if TASK_DIR.match(e.name) and e.is_dir(follow_symlinks=False)]
+
+    def scan(self):
+        work_roots = self._work_roots()
+        self.skipped_trees = [w for w in work_roots if self._is_in_use(w)]
+        buckets = [b for w in work_roots if w not in self.skipped_trees for b in self._buckets(w)]
+        with ThreadPoolExecutor(self.threads) as pool:
+            found = [t for tasks in pool.map(self._tasks, buckets) for t in tasks]
+            self.tasks = [t for t in pool.map(self._size, found) if t.mtime < self.cutoff and t.bytes >= self.min_bytes]
+        return self
+
+    @property
+    def bytes(self) -> int:
+        return sum(t.bytes for t in self.tasks)
+
+    @property
+    def inodes(self) -> int:
+        return sum(t.inodes for t in self.tasks)
+
+    def _error(self, path: str, e: OSError):
+        with self._errors_lock:
+            self.errors += 1
+        logging.debug(f'could not remove {path}: {e}')
+
+    def _remove(self, path: str):
+        for entry in self._scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    self._remove(entry.path)
+                else:
+                    self.limit()
+                    os.unlink(entry.path)
+            except OSError as e:
+                self._error(entry.path, e)
+        self.limit()
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            self._error(path, e)
+
+    def _remove_task(self, task: TaskDir):
+        # A session may have started since the scan
+        with contextlib.suppress(OSError):
+            if os.stat(task.path).st_mtime < self.cutoff:
+                self._remove(task.path)
+
+    def delete(self):
+        work_trees = {os.path.dirname(os.path.dirname(t.path)) for t in self.tasks}
+        in_use = {w for w in work_trees if self._is_in_use(w)}
+        with ThreadPoolExecutor(self.threads) as pool:
+            list(pool.map(self._remove_task, [t for t in self.tasks if os.path.dirname(os.path.dirname(t.path)) not in in_use]))
+        return self
+
+def format_bytes(n: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if n < 1024 or unit == 'TB':
+            return f'{n:.1f}{unit}'
+        n /= 1024
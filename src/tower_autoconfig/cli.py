@@ -3,10 +3,15 @@ import os, asyncio, logging, argparse, string, sys
 from io import StringIO
 
 from tower_autoconfig.autoconfig import TowerAutoconfig
+from tower_autoconfig.watch import TowerAutoconfigWatcher
+from tower_autoconfig.sizing import HeadJobSizingError, format_walltime, iter_workflows
+from tower_autoconfig.cleanup import WorkdirCleaner, format_bytes
 from tower_autoconfig.api import RECOGNIZED_PLATFORMS
 from tower_autoconfig.agent import EXEC_PATH
 from tower_autoconfig.utils import AUTH_KEY_PATH, guess_node, guess_platform, create_ssh_restriction, source_to_text, verify_external_server_is_me
 
+ACTIVE_STATUSES = ('SUBMITTED', 'RUNNING')
+
 def _get_name(host):
     return host.split('.', 1)[0].rstrip(string.digits) + 'auto'
 
@@ -55,16 +60,19 @@ async def _validate(command, subcommand, server, workspace_id, user, node, compu
 
     return False, msg.getvalue()
         
+def _confirm(prompt):
+    while True:
+        answer = input(f'{prompt} (y/n)?\n')
+        if answer.lower() in ['y', 'yes']: return True
+        elif answer.lower() in ['n', 'no']: return False
+
 async def _ask(*args):
     is_already_valid, msg = await _validate(*args)
     print(msg)
     if is_already_valid: return is_already_valid, False
-    while True:
-        answer = input('continue (y/n)?\n')
-        if answer.lower() in ['y', 'yes']: return is_already_valid, True
-        elif answer.lower() in ['n', 'no']: return is_already_valid, False
+    return is_already_valid, _confirm('continue')
 
-async def _run(command=None, subcommand=None, server='tower.nf', node=DEFAULT_NODE, platform=DEFAULT_PLATFORM, queue_options=None, launchdir=None, pipelines=[], profiles=[], config='', prerun='', force=False, yes=False, verbose=False, days=30, bearer=None, workspace_id=None, ask_callback=None):    
+async def _run(command=None, subcommand=None, server='tower.nf', node=DEFAULT_NODE, platform=DEFAULT_PLATFORM, queue_options=None, launchdir=None, pipelines=[], profiles=[], config='', prerun='', force=False, wait=0, agent_log=None, yes=False, verbose=False, days=30, bearer=None, workspace_id=None, ask_callback=None):    
     if launchdir: launchdir = os.path.abspath(os.path.expanduser(launchdir))
 
     # Trailing numbers are stripped to try to get "main" login node
@@ -102,10 +110,10 @@ async def _run(command=None, subcommand=None, server='tower.nf', node=DEFAULT_NO
         if command == 'setup':
             if subcommand == 'ssh':
                 ssh_restrictions = f'restrict,pty,{create_ssh_restriction(days)}'
-                compute_id, credentials_id = await auto.setup_ssh(compute_name, '', platform, node, compute_user, queue_options, launchdir, credentials_name, '', compute_id, credentials_id, force, ssh_restrictions)
+                compute_id, credentials_id = await auto.setup_ssh(compute_name, '', platform, node, compute_user, queue_options, launchdir, credentials_name, '', compute_id, credentials_id, force, ssh_restrictions, wait_timeout=wait)
             elif subcommand == 'agent':
                 agent_connection_id = compute_name
-                compute_id, credentials_id = await auto.setup_agent(compute_name, '', platform, node, compute_user, queue_options, launchdir, credentials_name, '', compute_id, credentials_id, force, agent_connection_id, bearer=bearer)
+                compute_id, credentials_id = await auto.setup_agent(compute_name, '', platform, node, compute_user, queue_options, launchdir, credentials_name, '', compute_id, credentials_id, force, agent_connection_id, bearer=bearer, wait_timeout=wait, agent_log=agent_log)
 
             if pipelines: 
                 # Group and run all independent tasks, including adding labels
@@ -127,6 +135,65 @@ async def _run(command=None, subcommand=None, server='tower.nf', node=DEFAULT_NO
                 print(f'    a) tower-autoconfig-agent {agent_connection_id} {launchdir} {auto.endpoint} 43200')
                 print(f'    b) tw-agent --work-dir {launchdir} --url {auto.endpoint} {agent_connection_id}')
 
+async def _watch(server='tower.nf', node=DEFAULT_NODE, config=None, prerun=None, interval=2, debounce=5, once=False, bearer=None, workspace_id=None, **_):
+    pipeline_suffix = '_' + _get_name(node)
+    async with TowerAutoconfig(server, bearer, workspace_id) as auto:
+        print(f'Watching pipelines with the suffix "{pipeline_suffix}" (https://{server} -- {workspace_id or "personal"})')
+        watcher = TowerAutoconfigWatcher(auto, pipeline_suffix, config, prerun, interval=interval, debounce=debounce)
+        synced, updated = await watcher.start()
+        print(f'Watching {len(watcher.pipelines)} pipeline(s), {len(updated)} updated{"" if synced else " (some failed, will retry)"}')
+        if not once:
+            await watcher.run(synced, lambda updated: print(f'Updated {len(updated)} pipeline(s): {", ".join(updated)}'))
+
+async def _size(server='tower.nf', node=DEFAULT_NODE, queue_options=None, runs=1000, percentile=95, apply=False, yes=False, bearer=None, workspace_id=None, **_):
+    compute_name = _get_name(node)
+    async with TowerAutoconfig(server, bearer, workspace_id) as auto:
+        compute_id = auto.api.get_compute_id_by_name(await auto.api.get_compute(), compute_name)
+        if not compute_id:
+            print(f'No compute environment "{compute_name}" - run setup first')
+            return
+        print(f'Analysing up to {runs} recent runs on "{compute_name}"...')
+        try:
+            compute_env, history, duration, current, proposed = await auto.propose_head_job_options(compute_id, queue_options, percentile, runs)
+        except HeadJobSizingError as e:
+            print(e)
+            return
+        if duration is None:
+            print('No finished runs found for this compute environment')
+            return
+        print(f'Runs analysed: {history.durations.count}, p50 {format_walltime(history.durations.percentile(50))}, p{percentile:g} {format_walltime(duration)}')
+        print(f'Current head job options:  {current or "(none)"}')
+        print(f'Proposed head job options: {proposed}')
+        if not apply or proposed == current:
+            return
+        if not yes and not _confirm('apply'):
+            return
+        await auto.apply_head_job_options(compute_env, proposed)
+        print('Finished updating compute environment')
+
+async def _clean_workdirs(server='tower.nf', launchdir=None, older_than=7, min_size=0, dry_run=False, threads=8, max_ops=2000, yes=False, bearer=None, workspace_id=None):
+    launchdir = os.path.abspath(os.path.expanduser(launchdir))
+    async with TowerAutoconfig(server, bearer, workspace_id) as auto:
+        # Only active runs are requested, but all of them, however long ago they started
+        active_workdirs = []
+        for status in ACTIVE_STATUSES:
+            active_workdirs += [w['workflow'].get('workDir') async for w in iter_workflows(auto.api, None, search=f'status:{status.lower()}')
+                                if w['workflow'].get('status') in ACTIVE_STATUSES]
+
+    loop = asyncio.get_event_loop()
+    print(f'Scanning "{launchdir}" for task directories older than {older_than:g} days...')
+    cleaner = WorkdirCleaner(launchdir, older_than, int(min_size * 1024 * 1024), threads, max_ops, [w for w in active_workdirs if w])
+    await loop.run_in_executor(None, cleaner.scan)
+    for w in cleaner.skipped_trees:
+        print(f'Skipping "{w}" - in use by a running workflow')
+    print(f'Task directories to DELETE: {len(cleaner.tasks)} ({format_bytes(cleaner.bytes)}, {cleaner.inodes} inodes)')
+    if dry_run or not cleaner.tasks:
+        return
+    if not yes and not _confirm('continue'):
+        return
+    await loop.run_in_executor(None, cleaner.delete)
+    print(f'Finished cleaning task directories{f" ({cleaner.errors} could not be removed, see --verbose)" if cleaner.errors else ""}')
+
 async def run(argv):
     parser = argparse.ArgumentParser(description='Tower Autoconfig', epilog='Environment variables: TOWER_ACCESS_TOKEN, TOWER_WORKSPACE_ID (optional)')
     parent_all = argparse.ArgumentParser(add_help=False)
@@ -143,6 +210,7 @@ async def run(argv):
     setup_parent.add_argument('--profiles', nargs='+', help='if provided, profiles assigned to any NEW/UPDATED pipelines')
     setup_parent.add_argument('--config', help='nextflow config file/url assigned to NEW/UPDATED pipelines for when there is no organisation profile')
     setup_parent.add_argument('--prerun', help='script to prepare launch environment e.g load module')
+    setup_parent.add_argument('--wait', type=float, default=0, help='seconds to wait for a new/updated compute environment to become AVAILABLE (default: %(default)s, no wait)')
     setup_parent.add_argument('-f', '--force', help=f'force reload pipelines/compute if e.g. config has changed - does not break existing runs', action='store_true')
 
     main_subparsers = parser.add_subparsers(title='commands', dest='command')
@@ -150,11 +218,30 @@ async def run(argv):
 
     setup_parser = main_subparsers.add_parser('setup', help='setup/update current machine as Tower compute environment and load/replace requested nf-core pipelines')
     cleanup_parser = main_subparsers.add_parser('clean', help='remove associated credentials, compute environments, pipelines and labels', parents=[parent_all])
+    cleanup_parser.add_argument('--workdirs', help='also delete old Nextflow task directories under --launchdir', action='store_true')
+    cleanup_parser.add_argument('--launchdir', help='scratch directory used for launching workflows')
+    cleanup_parser.add_argument('--older_than', type=float, default=7, help='only delete task directories unmodified for this many days (default: %(default)s)')
+    cleanup_parser.add_argument('--min_size', type=float, default=0, help='only delete task directories of at least this many MB (default: %(default)s)')
+    cleanup_parser.add_argument('--dry_run', help='only summarise task directories that would be deleted, without cleaning anything in Tower', action='store_true')
+    cleanup_parser.add_argument('--threads', type=int, default=8, help='threads used to scan and delete (default: %(default)s)')
+    cleanup_parser.add_argument('--max_ops', type=float, default=2000, help='maximum filesystem metadata operations per second (default: %(default)s)')
+    watch_parser = main_subparsers.add_parser('watch', help='keep pipelines in sync with changing --config/--prerun, pushing only what changed', parents=[parent_all])
+    watch_parser.add_argument('--config', help='nextflow config file/url to keep in sync on existing pipelines')
+    watch_parser.add_argument('--prerun', help='pre-run script file/url to keep in sync on existing pipelines')
+    watch_parser.add_argument('--interval', type=float, default=2, help='seconds between local file checks (default: %(default)s)')
+    watch_parser.add_argument('--debounce', type=float, default=5, help='seconds without changes before pushing (default: %(default)s)')
+    watch_parser.add_argument('--once', help='reconcile once and exit', action='store_true')
+    size_parser = main_subparsers.add_parser('size', help='propose head job walltime from previous runs on this compute environment', parents=[parent_all])
+    size_parser.add_argument('--queue_options', help='head job options to resize (default: those on the compute environment)')
+    size_parser.add_argument('--runs', type=int, default=1000, help='maximum number of recent runs to analyse (default: %(default)s)')
+    size_parser.add_argument('--percentile', type=float, default=95, help='run duration percentile to cover (default: %(default)s)')
+    size_parser.add_argument('--apply', help='update the compute environment with the proposed options', action='store_true')
 
     setup_subparsers = setup_parser.add_subparsers(title='subcommands', dest='subcommand')
     setup_subparsers.required = True
 
     setup_agent_parser = setup_subparsers.add_parser('agent', help='launch and configure Tower Agent', parents=[parent_all, setup_parent])
+    setup_agent_parser.add_argument('--agent_log', help='file to write Tower Agent output to during setup, rotated at 10MB')
     setup_ssh_parser = setup_subparsers.add_parser('ssh', help='generate and configure SSH key', parents=[parent_all, setup_parent])
     setup_ssh_parser.add_argument('--days', type=int, default=30, help='days SSH key will be valid (default: %(default)s)')
 
@@ -185,7 +272,35 @@ async def run(argv):
     if args.command == 'setup' and args.subcommand == 'ssh' and args.node == DEFAULT_NODE and not verify_external_server_is_me(EXTERNAL_IP):
         parser.error('Invalid node, manually specify')
 
-    await _run(bearer=bearer, workspace_id=workspace_id, ask_callback=_ask, **vars(args))
+    if args.command == 'watch':
+        if not (args.config or args.prerun):
+            parser.error('Nothing to watch - provide --config and/or --prerun')
+        await _watch(bearer=bearer, workspace_id=workspace_id, **vars(args))
+        return
+
+    if args.command == 'size':
+        if not 0 < args.percentile <= 100:
+            parser.error('--percentile must be greater than 0 and at most 100')
+        await _size(bearer=bearer, workspace_id=workspace_id, **vars(args))
+        return
+
+    if args.command == 'clean' and args.workdirs and not args.launchdir:
+        parser.error('--workdirs requires --launchdir')
+
+    if args.command == 'clean' and args.dry_run and not args.workdirs:
+        parser.error('--dry_run requires --workdirs')
+
+    if args.command == 'clean' and args.launchdir and not os.path.exists(args.launchdir):
+        parser.error(f'Launch directory "{args.launchdir}" does not exist')
+
+    kwargs = vars(args)
+    workdir_kwargs = {k: kwargs.pop(k) for k in ['workdirs', 'older_than', 'min_size', 'dry_run', 'threads', 'max_ops'] if k in kwargs}
+    # A dry run must not touch Tower, and declining the Tower clean (False) also skips the workdirs
+    tower_result = None if workdir_kwargs.get('dry_run') else await _run(bearer=bearer, workspace_id=workspace_id, ask_callback=_ask, **kwargs)
+
+    if workdir_kwargs.get('workdirs') and tower_result is not False:
+        del workdir_kwargs['workdirs']
+        await _clean_workdirs(args.server, args.launchdir, yes=args.yes, bearer=bearer, workspace_id=workspace_id, **workdir_kwargs)
 
 def agent():
     os.execv(EXEC_PATH, sys.argv)
@@ -0,0 +1,101 @@
+import asyncio, math, random, re, sys
+from typing import Any, List, Optional
+
+from tower_autoconfig.api import TowerApi
+
+class HeadJobSizingError(Exception):
+    pass
+
+SIZED_STATUSES = {'SUCCEEDED', 'FAILED'}
+
+# (existing option pattern, replacement, appended if missing) - walltime only, see HeadJobHistory
+PLATFORM_WALLTIME = {
+    'altair-platform': (r'walltime=[0-9:]+', 'walltime={hms}', '-l walltime={hms}'),
+    'moab-platform': (r'walltime=[0-9:]+', 'walltime={hms}', '-l walltime={hms}'),
+    'slurm-platform': (r'(--time[= ]|-t ?)[0-9:-]+', '--time={hms}', '--time={hms}'),
+    'lsf-platform': (r'-W ?[0-9:]+', '-W {hm}', '-W {hm}'),
+    'uge-platform': (r'h_rt=[0-9:]+', 'h_rt={hms}', '-l h_rt={hms}'),
+}
+
+async def iter_workflows(api: TowerApi, max_runs: Optional[int]=1000, page_size: int=100, concurrency: int=4, search: Optional[str]=None):
+    '''Yields recent workflow records (all of them if max_runs is None), fetching up to "concurrency" pages at a time through the API throttle'''
+    max_runs = sys.maxsize if max_runs is None else max_runs
+    offset = 0
+    while offset < max_runs:
+        requests = [(o, min(page_size, max_runs - o)) for o in range(offset, min(offset + page_size * concurrency, max_runs), page_size)]
+        pages = await asyncio.gather(*[api.get_workflows(n, o, search) for o, n in requests])
+        for workflows, _ in pages:
+            for w in workflows:
+                yield w
+        offset = requests[-1][0] + page_size
+        total = pages[-1][1]
+        if any(len(workflows) < n for (workflows, _), (_, n) in zip(pages, requests)) or (total and offset >= total):
+            return
+
+'''
+Fixed-size uniform sample (reservoir sampling) so percentiles over any history length use constant memory
+'''
+class Reservoir:
+    def __init__(self, size: int=2000, rng: Optional[random.Random]=None):
+        self.size = size
+        self.count = 0
+        self.samples: List[float] = []
+        self._rng = rng or random.Random()
+
+    def add(self, value: float):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            i = self._rng.randrange(self.count)
+            if i < self.size:
+                self.samples[i] = value
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+'''
+Head job duration history for one compute environment.
+Tower records the head job's duration but not its memory, so only walltime is sized - memory in the existing options is kept.
+Runs are matched by compute environment id when the record has one, otherwise by being launched under its work directory.
+'''
+class HeadJobHistory:
+    def __init__(self, compute_id: str, workdir: Optional[str], reservoir_size: int=2000):
+        self.compute_id = compute_id
+        self.workdir = workdir.rstrip('/') + '/' if workdir else None
+        self.durations = Reservoir(reservoir_size)
+
+    def _matches(self, workflow: dict) -> bool:
+        compute_env = workflow.get('computeEnv')
+        if compute_env:
+            return compute_env.get('id') == self.compute_id
+        return bool(self.workdir) and ((workflow.get('workDir') or '').rstrip('/') + '/').startswith(self.workdir)
+
+    def add(self, record: Any):
+        workflow = record.get('workflow', record)
+        if workflow.get('status') in SIZED_STATUSES and workflow.get('duration') and self._matches(workflow):
+            self.durations.add(workflow['duration'] / 1000)
+
+    async def load(self, api: TowerApi, max_runs: int=1000):
+        async for record in iter_workflows(api, max_runs):
+            self.add(record)
+        return self
+
+def format_walltime(seconds: float) -> str:
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def propose_walltime(duration: float, margin: float=1.25, step: int=900) -> int:
+    return max(3600, math.ceil(duration * margin / step) * step)
+
+def size_head_job_options(platform: str, queue_options: Optional[str], walltime: int) -> str:
+    if platform not in PLATFORM_WALLTIME:
+        raise HeadJobSizingError(f'Head job sizing is not supported for "{platform}"')
+    pattern, replacement, appended = PLATFORM_WALLTIME[platform]
+    values = {'hms': format_walltime(walltime), 'hm': format_walltime(walltime)[:-3]}
+    queue_options = (queue_options or '').replace('"', '').strip()
+    if re.search(pattern, queue_options):
+        return re.sub(pattern, replacement.format(**values), queue_options, count=1)
+    return f'{queue_options} {appended.format(**values)}'.strip()
@@ -0,0 +1,179 @@
+import asyncio, logging, os, stat, time, urllib.request, urllib.error
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tower_autoconfig.autoconfig import TowerAutoconfig
+
+'''
+A file/url that is only re-read when it has actually changed.
+Local files are compared by stat (no read), urls by a conditional GET using ETag/Last-Modified.
+Anything else (e.g. a <(...) process substitution) can only be read once, so is never considered changed.
+There is no inotify in the standard library, and stat polling on a handful of paths is effectively free.
+'''
+class WatchedSource:
+    def __init__(self, source: Optional[str], url_interval: float=60, url_timeout: float=30):
+        self.source = source
+        self.url_interval = url_interval
+        self.url_timeout = url_timeout
+        self.text = None
+        self._polled = False
+        self._signature = None
+        self._etag = self._last_modified = None
+        self._next_url_check = 0
+        self._is_url = bool(source) and source.startswith('https://')
+        self._is_static = not source
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.source)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            self._is_static = True
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _read_file(self) -> Optional[str]:
+        try:
+            with open(self.source, 'r') as f:
+                return f.read()
+        except OSError:
+            logging.warning(f'{self.source} could not be resolved')
+            return None
+
+    def _read_url(self) -> Optional[str]:
+        headers = {**({'If-None-Match': self._etag} if self._etag else {}), **({'If-Modified-Since': self._last_modified} if self._last_modified else {})}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.source, headers=headers), timeout=self.url_timeout) as r:
+                self._etag, self._last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+                return r.read().decode()
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                logging.warning(f'{self.source} could not be resolved ({e.code})')
+        except Exception:
+            logging.warning(f'{self.source} could not be resolved')
+        return self.text
+
+    async def poll(self) -> bool:
+        '''Returns True if the source text changed since the last poll'''
+        if self._is_static and self._polled:
+            return False
+
+        if self._is_url:
+            now = time.monotonic()
+            if now < self._next_url_check:
+                return False
+            self._next_url_check = now + self.url_interval
+            text = await asyncio.get_event_loop().run_in_executor(None, self._read_url)
+        elif self.source:
+            signature = self._stat_signature()
+            if self._polled and signature == self._signature:
+                return False
+            self._signature = signature
+            text = self._read_file() if signature else None
+        else:
+            text = None
+
+        self._polled = True
+        changed = text != self.text
+        self.text = text
+        return changed
+
+'''
+Keeps a TowerAutoconfig session open and reconciles the pipelines ending in the cluster's suffix against --config/--prerun.
+Sources are polled cheaply, changes are debounced, and only pipelines whose configText/preRunScript differ are updated.
+Failed API calls are logged and retried on a later cycle rather than stopping the watcher.
+The pipeline list is refreshed on a slower interval so renamed/re-added pipelines are picked up without a restart.
+'''
+class TowerAutoconfigWatcher:
+    def __init__(self, auto: TowerAutoconfig, pipeline_suffix: str, config: Optional[str], prerun: Optional[str],
+                 interval: float=2, debounce: float=5, url_interval: float=60, pipeline_interval: float=300):
+        self.auto = auto
+        self.pipeline_suffix = pipeline_suffix
+        self.sources = {'configText': WatchedSource(config, url_interval), 'preRunScript': WatchedSource(prerun, url_interval)}
+        self.interval = interval
+        self.debounce = debounce
+        self.pipeline_interval = pipeline_interval
+        self._pipelines: Dict[str, dict] = {}
+
+    async def _refresh_pipelines(self) -> bool:
+        pipelines = await self.auto.api.get_pipelines(['labels'])
+        current = {p['pipelineId']: p for p in pipelines if p['name'].endswith(self.pipeline_suffix)}
+        changed = current.keys() != self._pipelines.keys()
+        self._pipelines = current
+        return changed
+
+    async def _push_pipeline(self, pipeline_id: str) -> bool:
+        # Fetched right before each push so edits made in the UI since startup are sent back unchanged, not reverted
+        launch = await self.auto.api.get_pipeline_launch(pipeline_id)
+        p = self._pipelines[pipeline_id]
+        fields = {k: s.text for k, s in self.sources.items() if s.source and s.text is not None and launch.get(k) != s.text}
+        if not fields:
+            return False
+        if not launch.get('computeEnv'):
+            logging.warning(f'Skipping pipeline "{p["name"]}" - it has no compute environment')
+            return False
+        await self.auto.api.update_pipeline_launch(pipeline_id, p['name'], p.get('description'), p.get('icon'), launch,
+                                                   [l['id'] for l in p.get('labels') or []], fields)
+        logging.info(f'Updated {", ".join(fields)} on pipeline "{p["name"]}"')
+        return True
+
+    async def reconcile(self) -> Tuple[List[str], int]:
+        '''Returns the names of updated pipelines and how many could not be updated'''
+        pipeline_ids = list(self._pipelines)
+        results = await asyncio.gather(*[self._push_pipeline(i) for i in pipeline_ids], return_exceptions=True)
+        updated, failed = [], 0
+        for pipeline_id, result in zip(pipeline_ids, results):
+            name = self._pipelines[pipeline_id]['name']
+            if isinstance(result, Exception):
+                failed += 1
+                logging.warning(f'Could not update pipeline "{name}": {result}')
+            elif result:
+                updated.append(name)
+        return updated, failed
+
+    async def _poll_sources(self) -> bool:
+        return any(await asyncio.gather(*[s.poll() for s in self.sources.values()]))
+
+    @property
+    def pipelines(self) -> List[str]:
+        return [p['name'] for p in self._pipelines.values()]
+
+    async def _sync(self, refresh: bool) -> Tuple[bool, List[str]]:
+        '''Returns False if anything failed, so the caller can retry on a later cycle, and the updated pipeline names'''
+        try:
+            if refresh:
+                await self._refresh_pipelines()
+            updated, failed = await self.reconcile()
+        except Exception as e:
+            logging.warning(f'Could not sync pipelines, will retry: {e}')
+            return False, []
+        return not failed, updated
+
+    async def start(self) -> Tuple[bool, List[str]]:
+        await self._poll_sources()
+        return await self._sync(refresh=True)
+
+    async def run(self, synced: bool, update_callback: Optional[Callable[[List[str]], None]]=None):
+        '''Runs forever after start(), calling update_callback with the names of pipelines each time some are updated'''
+        next_pipeline_refresh = time.monotonic() + (self.pipeline_interval if synced else self.debounce)
+        dirty_since = None if synced else time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+
+            changed = await self._poll_sources()
+            if now >= next_pipeline_refresh:
+                next_pipeline_refresh = now + self.pipeline_interval
+                try:
+                    changed = await self._refresh_pipelines() or changed
+                except Exception as e:
+                    logging.warning(f'Could not refresh pipelines, will retry: {e}')
+                    next_pipeline_refresh = now + self.debounce
+
+            # Wait for a quiet period so editors writing in several steps cause a single push, and stay dirty until it succeeds
+            if changed:
+                dirty_since = now
+            elif dirty_since is not None and now - dirty_since >= self.debounce:
+                synced, updated = await self._sync(refresh=False)
+                dirty_since = None if synced else now
+                if updated and update_callback:
+                    update_callback(updated)